@@ -1,12 +1,32 @@
 #!/usr/bin/env python
+import json
+from typing import Any
 from typing import Dict
+from typing import List
 from typing import Optional
 
 import click
 import requests
-from yaml import dump
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from yaml import dump, load
+
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    # PyYAML was built without libyaml, so we fallback to the pure python implementation.
+    from yaml import SafeDumper, SafeLoader
+
 from cachet_url_monitor import latency_unit, status, exceptions
 
+# How many items we request per page when listing components and metrics.
+PAGE_SIZE = 100
+
+# Status values used when pushing incidents, resolved once instead of going through the enums on every call.
+OPERATIONAL = status.ComponentStatus.OPERATIONAL
+INCIDENT_FIXED = status.IncidentStatus.FIXED.value
+INCIDENT_INVESTIGATING = status.IncidentStatus.INVESTIGATING.value
+
 
 def normalize_url(url: str) -> str:
     """If passed url doesn't include schema return it with default one - http."""
@@ -15,9 +35,27 @@ def normalize_url(url: str) -> str:
     return url
 
 
+def is_json_file(filename: str) -> bool:
+    """JSON is only used when explicitly requested through the file extension, YAML is the default format."""
+    return filename.lower().endswith(".json")
+
+
 def save_config(config_map, filename: str):
     with open(filename, "w") as file:
-        dump(config_map, file)
+        if is_json_file(filename):
+            json.dump(config_map, file, indent=2)
+        else:
+            dump(config_map, file, Dumper=SafeDumper)
+
+
+def load_config(filename: str) -> Dict[str, Any]:
+    """Reads the configuration file, either in YAML or JSON format. The file is read as bytes, so the parsers detect
+    the encoding themselves instead of relying on the platform's default one.
+    """
+    with open(filename, "rb") as file:
+        if is_json_file(filename):
+            return json.load(file)
+        return load(file, SafeLoader)
 
 
 class CachetClient(object):
@@ -26,22 +64,49 @@ class CachetClient(object):
     url: str
     token: str
     headers: Dict[str, str]
+    session: requests.Session
+    default_metric_values: Dict[int, float]
 
     def __init__(self, url: str, token: str):
         self.url = normalize_url(url)
         self.token = token
         self.headers = {"X-Cachet-Token": token}
 
-    def get_components(self):
-        """Retrieves all components registered in cachet-hq"""
-        return requests.get(f"{self.url}/components", headers=self.headers).json()["data"]
+        # A single session is shared by every call, so the connection to the cachet server is kept alive between
+        # the monitoring cycles instead of paying the TCP/TLS handshake on every request.
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=Retry(total=3, backoff_factor=0.1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Endpoints sharing a metric only fetch its default value once.
+        self.default_metric_values = {}
+
+    def get_paginated_data(self, url: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Retrieves all the pages of a cachet-hq listing. The given params are only sent with the first request, as
+        the next page link already includes them.
+        """
+        data = []
+        next_page: Optional[str] = url
+        while next_page:
+            response = self.session.get(next_page, params=params).json()
+            data.extend(response["data"])
+            next_page = response.get("meta", {}).get("pagination", {}).get("links", {}).get("next_page")
+            params = None
+        return data
+
+    def get_components(self, **filters):
+        """Retrieves all components registered in cachet-hq. The filters are sent as query parameters, so the
+        filtering happens on the server side.
+        """
+        return self.get_paginated_data(f"{self.url}/components", {"per_page": PAGE_SIZE, **filters})
 
     def get_metrics(self):
         """Retrieves all metrics registered in cachet-hq"""
-        return requests.get(f"{self.url}/metrics", headers=self.headers).json()["data"]
+        return self.get_paginated_data(f"{self.url}/metrics", {"per_page": PAGE_SIZE})
 
     def generate_config(self):
-        components = self.get_components()
+        components = self.get_components(enabled=1)
         generated_endpoints = [
             {
                 "name": component["name"],
@@ -63,10 +128,15 @@ class CachetClient(object):
 
     def get_default_metric_value(self, metric_id):
         """Returns default value for configured metric."""
-        get_metric_request = requests.get(f"{self.url}/metrics/{metric_id}", headers=self.headers)
+        if metric_id in self.default_metric_values:
+            return self.default_metric_values[metric_id]
+
+        get_metric_request = self.session.get(f"{self.url}/metrics/{metric_id}")
 
         if get_metric_request.ok:
-            return get_metric_request.json()["data"]["default_value"]
+            default_value = get_metric_request.json()["data"]["default_value"]
+            self.default_metric_values[metric_id] = default_value
+            return default_value
         else:
             raise exceptions.MetricNonexistentError(metric_id)
 
@@ -75,7 +145,7 @@ class CachetClient(object):
         not exist or doesn't respond with the expected data.
         :return component status.
         """
-        get_status_request = requests.get(f"{self.url}/components/{component_id}", headers=self.headers)
+        get_status_request = self.session.get(f"{self.url}/components/{component_id}")
 
         if get_status_request.ok:
             # The component exists.
@@ -87,14 +157,14 @@ class CachetClient(object):
         """Pushes the status of the component to the cachet server.
         """
         params = {"id": component_id, "status": component_status.value}
-        return requests.put(f"{self.url}/components/{component_id}", params=params, headers=self.headers)
+        return self.session.put(f"{self.url}/components/{component_id}", params=params)
 
     def push_metrics(self, metric_id: int, latency_time_unit: str, elapsed_time_in_seconds: int, timestamp: int):
         """Pushes the total amount of seconds the request took to get a response from the URL.
         """
         value = latency_unit.convert_to_unit(latency_time_unit, elapsed_time_in_seconds)
         params = {"id": metric_id, "value": value, "timestamp": timestamp}
-        return requests.post(f"{self.url}/metrics/{metric_id}/points", params=params, headers=self.headers)
+        return self.session.post(f"{self.url}/metrics/{metric_id}/points", params=params)
 
     def push_incident(
         self,
@@ -108,25 +178,23 @@ class CachetClient(object):
         """If the component status has changed, we create a new incident (if this is the first time it becomes unstable)
         or updates the existing incident once it becomes healthy again.
         """
-        if previous_incident_id and status_value == status.ComponentStatus.OPERATIONAL:
+        if previous_incident_id and status_value == OPERATIONAL:
             # If the incident already exists, it means it was unhealthy but now it's healthy again, post update
-            params = {"status": status.IncidentStatus.FIXED.value, "message": title}
+            params = {"status": INCIDENT_FIXED, "message": title}
 
-            return requests.post(
-                f"{self.url}/incidents/{previous_incident_id}/updates", params=params, headers=self.headers
-            )
-        elif not previous_incident_id and status_value != status.ComponentStatus.OPERATIONAL:
+            return self.session.post(f"{self.url}/incidents/{previous_incident_id}/updates", params=params)
+        elif not previous_incident_id and status_value != OPERATIONAL:
             # This is the first time the incident is being created.
             params = {
                 "name": title,
                 "message": message,
-                "status": status.IncidentStatus.INVESTIGATING.value,
+                "status": INCIDENT_INVESTIGATING,
                 "visible": is_public_incident,
                 "component_id": component_id,
                 "component_status": status_value.value,
                 "notify": True,
             }
-            return requests.post(f"{self.url}/incidents", params=params, headers=self.headers)
+            return self.session.post(f"{self.url}/incidents", params=params)
 
 
 @click.group()
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import copy
 import logging
 import time
 from typing import Dict
@@ -7,12 +6,15 @@ from typing import List
 from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from yaml import dump
 
 import cachet_url_monitor.status as st
-from cachet_url_monitor.client import CachetClient, normalize_url
-from cachet_url_monitor.exceptions import ConfigurationValidationError
+from cachet_url_monitor.client import CachetClient, SafeDumper, normalize_url
+from cachet_url_monitor.exceptions import ComponentNonexistentError, ConfigurationValidationError
 from cachet_url_monitor.expectation import Expectation
+from cachet_url_monitor.latency_unit import seconds_per_unit
 from cachet_url_monitor.status import ComponentStatus
 from cachet_url_monitor.webhook import Webhook
 
@@ -33,33 +35,97 @@ default_messages = {
     "incident_performance": "{name} has degraded performance",
 }
 
+# Transient failures (dropped connections and gateway errors) are retried within the same evaluation. Once retries are
+# exhausted the last response is still evaluated by the expectations, instead of raising. Retry-After is ignored, as a
+# server asking us to wait for minutes (e.g. a maintenance page) would stall the endpoint for that long. Read timeouts
+# are not retried, so they're still raised as timeouts instead of being wrapped into a connection error.
+endpoint_retry = Retry(
+    total=2,
+    connect=2,
+    read=False,
+    backoff_factor=0.2,
+    status_forcelist=(502, 503, 504),
+    raise_on_status=False,
+    respect_retry_after_header=False,
+)
+
+# Bodies up to this size are read even when no expectation needs them, as that's cheaper than dropping the keep-alive
+# connection and opening a new one on the next evaluation.
+MAX_DRAINED_BODY_SIZE = 4096
+
 
 class Configuration(object):
     """Represents a configuration file, but it also includes the functionality
     of assessing the API and pushing the results to cachet.
     """
 
+    __slots__ = (
+        "endpoint_index",
+        "data",
+        "endpoint",
+        "messages",
+        "client",
+        "webhooks",
+        "session",
+        "current_fails",
+        "trigger_update",
+        "logger",
+        "endpoint_method",
+        "request_method",
+        "max_body_size",
+        "endpoint_url",
+        "endpoint_timeout",
+        "endpoint_header",
+        "endpoint_verify",
+        "frequency",
+        "allowed_fails",
+        "component_id",
+        "metric_id",
+        "default_metric_value",
+        "latency_unit",
+        "public_incidents",
+        "expectations",
+        "needs_body",
+        "status",
+        "previous_status",
+        "message",
+        "request",
+        "elapsed_seconds",
+        "current_timestamp",
+        "incident_id",
+    )
+
     endpoint_index: int
     endpoint: str
     client: CachetClient
+    session: requests.Session
     webhooks: List[Webhook]
     current_fails: int
     trigger_update: bool
 
     endpoint_method: str
+    request_method: str
+    max_body_size: Optional[int]
     endpoint_url: str
     endpoint_timeout: int
     endpoint_header: Dict[str, str]
+    endpoint_verify: bool
+    frequency: int
 
     allowed_fails: int
     component_id: int
     metric_id: int
     default_metric_value: int
     latency_unit: str
+    needs_body: bool
 
     status: ComponentStatus
     previous_status: ComponentStatus
     message: str
+    request: Optional[requests.Response]
+    elapsed_seconds: float
+    current_timestamp: int
+    incident_id: Optional[int]
 
     def __init__(self, config, endpoint_index: int, client: CachetClient, webhooks: Optional[List[Webhook]] = None):
         self.endpoint_index = endpoint_index
@@ -68,9 +134,23 @@ class Configuration(object):
         self.messages = config.get("messages", default_messages)
         self.client = client
         self.webhooks = webhooks or []
+        # Keeps the connections to the monitored URL alive between evaluations, unless one is dropped to skip
+        # downloading a large body. Each configuration polls from its own thread, so one connection per host is enough,
+        # but a redirect to another host needs a pool of its own, or each evaluation would evict the other one.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=1, max_retries=endpoint_retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         self.current_fails = 0
         self.trigger_update = True
+        self.message = ""
+        # The last response from the monitored URL and when it was received. None until the first request succeeds.
+        self.request = None
+        self.elapsed_seconds = 0.0
+        self.current_timestamp = 0
+        # The incident we created in cachet, which is set while the component is unhealthy.
+        self.incident_id = None
 
         if "name" not in self.endpoint:
             # We have to make this mandatory, otherwise the logs are confusing when there are multiple URLs.
@@ -90,7 +170,12 @@ class Configuration(object):
         self.endpoint_url = normalize_url(self.endpoint["url"])
         self.endpoint_timeout = self.endpoint.get("timeout") or 1
         self.endpoint_header = self.endpoint.get("header") or None
-        self.allowed_fails = self.endpoint.get("allowed_fails") or 0
+        self.endpoint_verify = not self.endpoint["insecure"] if "insecure" in self.endpoint else True
+        self.frequency = self.endpoint["frequency"]
+        # How many bytes of the body the expectations look at. The whole body is read when it's not set.
+        self.max_body_size = self.endpoint.get("max_body_size")
+        allowed_fails = self.endpoint.get("allowed_fails")
+        self.allowed_fails = allowed_fails if allowed_fails is not None else 0
 
         self.component_id = self.endpoint["component_id"]
         self.metric_id = self.endpoint.get("metric_id")
@@ -99,20 +184,31 @@ class Configuration(object):
             self.default_metric_value = self.client.get_default_metric_value(self.metric_id)
 
         # The latency_unit configuration is not mandatory and we fallback to seconds, by default.
-        self.latency_unit = self.endpoint.get("latency_unit") or "s"
+        latency_unit = self.endpoint.get("latency_unit")
+        self.latency_unit = latency_unit if latency_unit is not None else "s"
 
         # We need the current status so we monitor the status changes. This is necessary for creating incidents.
         self.status = self.client.get_component_status(self.component_id)
         self.previous_status = self.status
-        self.logger.info(f"Component current status: {self.status}")
+        self.logger.info("Component current status: %s", self.status)
 
         # Get remaining settings
         self.public_incidents = int(self.endpoint["public_incidents"])
 
-        self.logger.info("Monitoring URL: %s %s" % (self.endpoint_method, self.endpoint_url))
+        self.logger.info("Monitoring URL: %s %s", self.endpoint_method, self.endpoint_url)
         self.expectations = [Expectation.create(expectation) for expectation in self.endpoint["expectation"]]
         for expectation in self.expectations:
-            self.logger.info("Registered expectation: %s" % (expectation,))
+            self.logger.info("Registered expectation: %s", expectation)
+        self.needs_body = any(expectation.needs_body for expectation in self.expectations)
+        # The expectations that read the body are the expensive ones, so they run last and can be skipped entirely
+        # when a cheaper one already reported the worst status. Within each group the most severe ones run first, so
+        # we can stop sooner. The sort is stable, keeping the configured order otherwise.
+        self.expectations.sort(key=lambda expectation: (expectation.needs_body, -expectation.incident_status.value))
+        # A HEAD request is enough when the body isn't checked, but some servers mishandle it, so it's opt-in.
+        if self.endpoint.get("use_head") and self.endpoint_method.upper() == "GET" and not self.needs_body:
+            self.request_method = "HEAD"
+        else:
+            self.request_method = self.endpoint_method
 
     def get_incident_title(self):
         """Generates incident title for current status."""
@@ -142,6 +238,19 @@ class Configuration(object):
             ):
                 configuration_errors.append("endpoint.expectation")
 
+        if self.endpoint.get("latency_unit") is not None and self.endpoint["latency_unit"] not in seconds_per_unit:
+            configuration_errors.append("endpoint.latency_unit")
+
+        if self.endpoint.get("allowed_fails") is not None and (
+            not isinstance(self.endpoint["allowed_fails"], int) or self.endpoint["allowed_fails"] < 0
+        ):
+            configuration_errors.append("endpoint.allowed_fails")
+
+        if "max_body_size" in self.endpoint and (
+            not isinstance(self.endpoint["max_body_size"], int) or self.endpoint["max_body_size"] <= 0
+        ):
+            configuration_errors.append("endpoint.max_body_size")
+
         for key, message in self.messages.items():
             if not isinstance(message, str):
                 configuration_errors.append(f"message.{key}")
@@ -157,66 +266,152 @@ class Configuration(object):
         according to the expectation results.
         """
         try:
-            if self.endpoint_header is None:
-                self.request = requests.request(self.endpoint_method, self.endpoint_url, timeout=self.endpoint_timeout)
+            start = time.monotonic_ns()
+            self.request = self.session.request(
+                self.request_method,
+                self.endpoint_url,
+                timeout=self.endpoint_timeout,
+                headers=self.endpoint_header,
+                verify=self.endpoint_verify,
+                stream=True,
+            )
+            # Measured around the whole request until the final response headers arrive, so it includes retries and
+            # redirects, unlike the response's elapsed time. Both the LATENCY expectation and the pushed metric use it.
+            self.elapsed_seconds = (time.monotonic_ns() - start) / 1e9
+
+            if self.needs_body:
+                # The body is downloaded and decoded here, so any failure while reading it is handled like a request
+                # failure. It's decoded only once and shared by all the expectations.
+                body = self.read_body() if self.max_body_size is None else self.read_body_prefix()
+            elif self.request_method == "HEAD" or self.has_small_body():
+                # There's little or no body to download, so reading it just hands the connection back to the pool.
+                self.request.content
+                body = None
             else:
-                self.request = requests.request(
-                    self.endpoint_method, self.endpoint_url, timeout=self.endpoint_timeout, headers=self.endpoint_header,
-                    verify=not self.endpoint['insecure'] if 'insecure' in self.endpoint else True
-                )
+                # None of the expectations look at the body and it's large (or of unknown size), so we drop the
+                # connection instead of downloading it.
+                self.request.close()
+                body = None
 
             self.current_timestamp = int(time.time())
         except requests.ConnectionError:
+            # This has to come first: ConnectTimeout is also a Timeout, but a host we can't connect to is unreachable
+            # rather than slow.
             self.message = "The URL is unreachable: %s %s" % (self.endpoint_method, self.endpoint_url)
             self.logger.warning(self.message)
             self.status = st.ComponentStatus.PARTIAL_OUTAGE
             return
-        except requests.HTTPError:
-            self.message = "Unexpected HTTP response"
-            self.logger.exception(self.message)
-            self.status = st.ComponentStatus.PARTIAL_OUTAGE
-            return
-        except (requests.Timeout, requests.ConnectTimeout):
+        except requests.Timeout:
             self.message = "Request timed out"
             self.logger.warning(self.message)
             self.status = st.ComponentStatus.PERFORMANCE_ISSUES
             return
+        except requests.RequestException:
+            # Anything else requests may raise, like an invalid response or too many redirects.
+            self.message = "Unexpected HTTP response"
+            self.logger.exception(self.message)
+            self.status = st.ComponentStatus.PARTIAL_OUTAGE
+            return
 
+        request = self.request
+        elapsed_seconds = self.elapsed_seconds
         # We initially assume the API is healthy.
-        self.status = st.ComponentStatus.OPERATIONAL
-        self.message = ""
+        worst_status = st.ComponentStatus.OPERATIONAL
+        # The enum value is kept as a plain int, so we don't have to look it up again on every comparison.
+        worst_value = worst_status.value
+        worst_expectation = None
         for expectation in self.expectations:
-            status: ComponentStatus = expectation.get_status(self.request)
+            status: ComponentStatus = expectation.get_status(request, body, elapsed_seconds)
 
             # The greater the status is, the worse the state of the API is.
-            if status.value > self.status.value:
-                self.status = status
-                self.message = expectation.get_message(self.request)
-                self.logger.info(self.message)
+            status_value = status.value
+            if status_value > worst_value:
+                worst_status = status
+                worst_value = status_value
+                worst_expectation = expectation
+                if status is st.ComponentStatus.MAJOR_OUTAGE:
+                    # Nothing can be worse than this, so the remaining expectations can't change the outcome.
+                    break
+
+        self.status = worst_status
+        if worst_expectation is None:
+            self.message = ""
+        else:
+            # Only the message of the expectation that decided the status is used, so it's the only one we build.
+            self.message = worst_expectation.get_message(request, elapsed_seconds)
+            self.logger.info(self.message)
+
+    def has_small_body(self) -> bool:
+        """Whether the response announced a body small enough to be read just to keep the connection alive."""
+        content_length = self.request.headers.get("Content-Length")
+        if content_length is None:
+            return False
+        try:
+            return int(content_length) <= MAX_DRAINED_BODY_SIZE
+        except ValueError:
+            return False
+
+    def read_body(self) -> str:
+        """Reads and decodes the response body. When the server doesn't tell the charset, requests guesses it from the
+        content, which is slow on large bodies, so we try UTF-8 first. A leading byte order mark is dropped, the same as
+        requests does when it detects UTF-8.
+        """
+        if self.request.encoding is None:
+            try:
+                return self.request.content.decode("utf-8-sig")
+            except UnicodeDecodeError:
+                pass
+        return self.request.text
+
+    def read_body_prefix(self) -> str:
+        """Reads and decodes at most max_body_size bytes of the response body, dropping the connection afterwards, so
+        huge responses don't have to be downloaded entirely.
+        """
+        content = bytearray()
+        for chunk in self.request.iter_content(chunk_size=8192):
+            content += chunk
+            if len(content) >= self.max_body_size:
+                break
+        self.request.close()
+
+        try:
+            return content[: self.max_body_size].decode(self.request.encoding or "utf-8-sig", "replace")
+        except LookupError:
+            # The server sent an encoding python doesn't know about.
+            return content[: self.max_body_size].decode("utf-8-sig", "replace")
 
     def print_out(self):
-        self.logger.info(f"Current configuration:\n{self.__repr__()}")
+        # Dumping the configuration is the expensive part, so we skip it entirely when it won't be logged.
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Current configuration:\n%s", self.__repr__())
 
     def __repr__(self):
-        temporary_data = copy.deepcopy(self.data)
-        temporary_data["endpoints"] = temporary_data["endpoints"][self.endpoint_index]
+        # A shallow copy is enough, as we only replace the top level keys. The token is left out so it's not logged.
+        temporary_data = dict(self.data)
+        temporary_data["endpoints"] = self.endpoint
+        if "cachet" in self.data:
+            temporary_data["cachet"] = {key: value for key, value in self.data["cachet"].items() if key != "token"}
 
-        return dump(temporary_data, default_flow_style=False)
+        return dump(temporary_data, Dumper=SafeDumper, default_flow_style=False)
 
     def if_trigger_update(self):
         """
         Checks if update should be triggered - trigger it for all operational states
         and only for non-operational ones above the configured threshold (allowed_fails).
         """
+        if self.status == st.ComponentStatus.OPERATIONAL:
+            self.current_fails = 0
+            self.trigger_update = True
+            return
 
-        if self.status != st.ComponentStatus.OPERATIONAL:
-            self.current_fails = self.current_fails + 1
-            self.logger.warning(f"Failure #{self.current_fails} with threshold set to {self.allowed_fails}")
-            if self.current_fails <= self.allowed_fails:
-                self.trigger_update = False
-                return
-        self.current_fails = 0
-        self.trigger_update = True
+        current_fails = self.current_fails + 1
+        self.logger.warning("Failure #%d with threshold set to %d", current_fails, self.allowed_fails)
+        if current_fails <= self.allowed_fails:
+            self.current_fails = current_fails
+            self.trigger_update = False
+        else:
+            self.current_fails = 0
+            self.trigger_update = True
 
     def push_status(self):
         """Pushes the status of the component to the cachet server. It will update the component
@@ -224,7 +419,7 @@ class Configuration(object):
         """
         if self.previous_status == self.status:
             # We don't want to keep spamming if there's no change in status.
-            self.logger.info(f"No changes to component status.")
+            self.logger.info("No changes to component status.")
             self.trigger_update = False
             return
 
@@ -233,37 +428,40 @@ class Configuration(object):
         if not self.trigger_update:
             return
 
-        api_component_status = self.client.get_component_status(self.component_id)
-
-        if self.status == api_component_status:
-            return
-
+        # We track the status locally, so we don't need to fetch it from cachet before updating it.
         component_request = self.client.push_status(self.component_id, self.status)
         if component_request.ok:
             # Successful update
-            self.logger.info(f"Component update: status [{self.status}]")
+            self.logger.info("Component update: status [%s]", self.status)
         else:
             # Failed to update the API status
             self.logger.warning(
-                f"Component update failed with HTTP status: {component_request.status_code}. API"
-                f" status: {self.status}"
+                "Component update failed with HTTP status: %s. API status: %s",
+                component_request.status_code,
+                self.status,
             )
+            # Our local copy is out of sync, so we fetch what cachet has. The update is retried on the next cycle if
+            # the status still differs.
+            try:
+                self.previous_status = self.client.get_component_status(self.component_id)
+            except (ComponentNonexistentError, requests.RequestException):
+                self.previous_status = st.ComponentStatus.UNKNOWN
 
     def push_metrics(self):
         """Pushes the total amount of seconds the request took to get a response from the URL.
         It only will send a request if the metric id was set in the configuration.
         In case of failed connection trial pushes the default metric value.
         """
-        if self.metric_id and hasattr(self, "request"):
+        if self.metric_id and self.request is not None:
             # We convert the elapsed time from the request, in seconds, to the configured unit.
             metrics_request = self.client.push_metrics(
-                self.metric_id, self.latency_unit, self.request.elapsed.total_seconds(), self.current_timestamp
+                self.metric_id, self.latency_unit, self.elapsed_seconds, self.current_timestamp
             )
             if metrics_request.ok:
                 # Successful metrics upload
-                self.logger.info("Metric uploaded: %.6f %s" % (self.request.elapsed.total_seconds(), self.latency_unit))
+                self.logger.info("Metric uploaded: %.6f %s", self.elapsed_seconds, self.latency_unit)
             else:
-                self.logger.warning(f"Metric upload failed with status [{metrics_request.status_code}]")
+                self.logger.warning("Metric upload failed with status [%s]", metrics_request.status_code)
 
     def trigger_webhooks(self):
         """Trigger webhooks."""
@@ -276,9 +474,9 @@ class Configuration(object):
         for webhook in self.webhooks:
             webhook_request = webhook.push_incident(self.get_incident_title(), self.message)
             if webhook_request.ok:
-                self.logger.info(f"Webhook {webhook.url} triggered with {title}")
+                self.logger.info("Webhook %s triggered with %s", webhook.url, title)
             else:
-                self.logger.warning(f"Webhook {webhook.url} failed with status [{webhook_request.status_code}]")
+                self.logger.warning("Webhook %s failed with status [%s]", webhook.url, webhook_request.status_code)
 
     def push_incident(self):
         """If the component status has changed, we create a new incident (if this is the first time it becomes unstable)
@@ -286,7 +484,7 @@ class Configuration(object):
         """
         if not self.trigger_update:
             return
-        if hasattr(self, "incident_id") and self.status == st.ComponentStatus.OPERATIONAL:
+        if self.incident_id is not None and self.status == st.ComponentStatus.OPERATIONAL:
             incident_request = self.client.push_incident(
                 self.status,
                 self.public_incidents,
@@ -298,16 +496,18 @@ class Configuration(object):
             if incident_request.ok:
                 # Successful metrics upload
                 self.logger.info(
-                    f'Incident updated, API healthy again: component status [{self.status}], message: "{self.message}"'
+                    'Incident updated, API healthy again: component status [%s], message: "%s"',
+                    self.status,
+                    self.message,
                 )
-                del self.incident_id
+                self.incident_id = None
             else:
                 self.logger.warning(
-                    f'Incident update failed with status [{incident_request.status_code}], message: "{self.message}"'
+                    'Incident update failed with status [%s], message: "%s"', incident_request.status_code, self.message
                 )
 
             self.trigger_webhooks()
-        elif not hasattr(self, "incident_id") and self.status != st.ComponentStatus.OPERATIONAL:
+        elif self.incident_id is None and self.status != st.ComponentStatus.OPERATIONAL:
             incident_request = self.client.push_incident(
                 self.status, self.public_incidents, self.component_id, self.get_incident_title(), message=self.message
             )
@@ -315,11 +515,11 @@ class Configuration(object):
                 # Successful incident upload.
                 self.incident_id = incident_request.json()["data"]["id"]
                 self.logger.info(
-                    f'Incident uploaded, API unhealthy: component status [{self.status}], message: "{self.message}"'
+                    'Incident uploaded, API unhealthy: component status [%s], message: "%s"', self.status, self.message
                 )
             else:
                 self.logger.warning(
-                    f'Incident upload failed with status [{incident_request.status_code}], message: "{self.message}"'
+                    'Incident upload failed with status [%s], message: "%s"', incident_request.status_code, self.message
                 )
 
             self.trigger_webhooks()
@@ -1,40 +1,78 @@
 #!/usr/bin/env python
 import abc
+import functools
 import re
+from typing import Optional
 
 import cachet_url_monitor.status as st
 from cachet_url_monitor.exceptions import ConfigurationValidationError
 from cachet_url_monitor.status import ComponentStatus
 
+REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]|()\\")
+
+
+@functools.lru_cache(maxsize=256)
+def compile_regex(regex: str):
+    """Compiles the given regex once, so endpoints sharing the same pattern also share the compiled object."""
+    return re.compile(regex, re.UNICODE | re.DOTALL)
+
+
+def get_searched_literal(regex: str) -> Optional[str]:
+    """Returns the literal text when the regex only looks for it anywhere in the body, like ".*(<body>).*". As the
+    regex is matched from the beginning with DOTALL, that is the same as a substring test, which is much cheaper.
+    Returns None when the regex can't be reduced to a substring test.
+    """
+    if not regex.startswith(".*"):
+        return None
+    literal = regex[2:]
+    if literal.endswith(".*"):
+        literal = literal[:-2]
+    if literal.startswith("(") and literal.endswith(")"):
+        literal = literal[1:-1]
+    if not literal or any(character in REGEX_SPECIAL_CHARACTERS for character in literal):
+        return None
+    return literal
+
 
 class Expectation(object):
     """Base class for URL result expectations. Any new expectation should extend
-    this class and the name added to create() method.
+    this class and the name added to EXPECTATION_TYPES.
     """
 
+    __slots__ = ("incident_status",)
+
+    # Whether the expectation reads the response body. The body is only downloaded when it's needed.
+    needs_body: bool = False
+
     @staticmethod
     def create(configuration):
         """Creates a list of expectations based on the configuration types
         list.
         """
-        # If a need expectation is created, this is where we need to add it.
-        expectations = {"HTTP_STATUS": HttpStatus, "LATENCY": Latency, "REGEX": Regex}
-        if configuration["type"] not in expectations:
+        try:
+            expectation_class = EXPECTATION_TYPES[configuration["type"]]
+        except KeyError:
             raise ConfigurationValidationError(f"Invalid type: {configuration['type']}")
 
-        return expectations.get(configuration["type"])(configuration)
+        return expectation_class(configuration)
 
     def __init__(self, configuration):
         self.incident_status = self.parse_incident_status(configuration)
 
     @abc.abstractmethod
-    def get_status(self, response) -> ComponentStatus:
+    def get_status(
+        self, response, body: Optional[str] = None, elapsed_seconds: Optional[float] = None
+    ) -> ComponentStatus:
         """Returns the status of the API, following cachet's component status
         documentation: https://docs.cachethq.io/docs/component-statuses
+
+        The body is the already decoded response text, so it's decoded only once for all the expectations. It's None
+        when no expectation reads the body. The elapsed seconds are the latency measured by the configuration, which
+        is also the one pushed as metric. When it's not given, the response's elapsed time is used.
         """
 
     @abc.abstractmethod
-    def get_message(self, response) -> str:
+    def get_message(self, response, elapsed_seconds: Optional[float] = None) -> str:
         """Gets the error message."""
 
     @abc.abstractmethod
@@ -46,8 +84,12 @@ class Expectation(object):
 
 
 class HttpStatus(Expectation):
+    __slots__ = ("status_range", "status_codes")
+
     def __init__(self, configuration):
         self.status_range = HttpStatus.parse_range(configuration["status_range"])
+        # range's membership test for integers is constant time, so we don't need to compare both boundaries.
+        self.status_codes = range(*self.status_range)
         super(HttpStatus, self).__init__(configuration)
 
     @staticmethod
@@ -64,8 +106,10 @@ class HttpStatus(Expectation):
             # We shouldn't look into more than one value, as this is a range value.
             return int(statuses[0]), int(statuses[1])
 
-    def get_status(self, response) -> ComponentStatus:
-        if self.status_range[0] <= response.status_code < self.status_range[1]:
+    def get_status(
+        self, response, body: Optional[str] = None, elapsed_seconds: Optional[float] = None
+    ) -> ComponentStatus:
+        if response.status_code in self.status_codes:
             return st.ComponentStatus.OPERATIONAL
         else:
             return self.incident_status
@@ -73,7 +117,7 @@ class HttpStatus(Expectation):
     def get_default_incident(self):
         return st.ComponentStatus.PARTIAL_OUTAGE
 
-    def get_message(self, response):
+    def get_message(self, response, elapsed_seconds: Optional[float] = None):
         return f"Unexpected HTTP status ({response.status_code})"
 
     def __str__(self):
@@ -81,12 +125,16 @@ class HttpStatus(Expectation):
 
 
 class Latency(Expectation):
+    __slots__ = ("threshold",)
+
     def __init__(self, configuration):
         self.threshold = configuration["threshold"]
         super(Latency, self).__init__(configuration)
 
-    def get_status(self, response) -> ComponentStatus:
-        if response.elapsed.total_seconds() <= self.threshold:
+    def get_status(
+        self, response, body: Optional[str] = None, elapsed_seconds: Optional[float] = None
+    ) -> ComponentStatus:
+        if self.get_elapsed_seconds(response, elapsed_seconds) <= self.threshold:
             return st.ComponentStatus.OPERATIONAL
         else:
             return self.incident_status
@@ -94,21 +142,41 @@ class Latency(Expectation):
     def get_default_incident(self):
         return st.ComponentStatus.PERFORMANCE_ISSUES
 
-    def get_message(self, response):
-        return "Latency above threshold: %.4f seconds" % (response.elapsed.total_seconds(),)
+    def get_message(self, response, elapsed_seconds: Optional[float] = None):
+        return "Latency above threshold: %.4f seconds" % (self.get_elapsed_seconds(response, elapsed_seconds),)
+
+    @staticmethod
+    def get_elapsed_seconds(response, elapsed_seconds: Optional[float]) -> float:
+        if elapsed_seconds is None:
+            return response.elapsed.total_seconds()
+        return elapsed_seconds
 
     def __str__(self):
         return repr("Latency threshold: %.4f seconds" % (self.threshold,))
 
 
 class Regex(Expectation):
+    __slots__ = ("regex_string", "regex", "literal")
+
+    needs_body = True
+
     def __init__(self, configuration):
         self.regex_string = configuration["regex"]
-        self.regex = re.compile(configuration["regex"], re.UNICODE + re.DOTALL)
+        self.regex = compile_regex(configuration["regex"])
+        self.literal = get_searched_literal(configuration["regex"])
         super(Regex, self).__init__(configuration)
 
-    def get_status(self, response) -> ComponentStatus:
-        if self.regex.match(response.text):
+    def matches(self, text: str) -> bool:
+        # The match is intentionally anchored at the beginning of the body (e.g. ".*<body>.*"), so existing
+        # configurations keep their semantics.
+        if self.literal is not None:
+            return self.literal in text
+        return self.regex.match(text) is not None
+
+    def get_status(
+        self, response, body: Optional[str] = None, elapsed_seconds: Optional[float] = None
+    ) -> ComponentStatus:
+        if self.matches(body if body is not None else response.text):
             return st.ComponentStatus.OPERATIONAL
         else:
             return self.incident_status
@@ -116,8 +184,12 @@ class Regex(Expectation):
     def get_default_incident(self):
         return st.ComponentStatus.PARTIAL_OUTAGE
 
-    def get_message(self, response):
+    def get_message(self, response, elapsed_seconds: Optional[float] = None):
         return "Regex did not match anything in the body"
 
     def __str__(self):
         return repr(f"Regex: {self.regex_string}")
+
+
+# If a new expectation is created, this is where we need to add it.
+EXPECTATION_TYPES = {"HTTP_STATUS": HttpStatus, "LATENCY": Latency, "REGEX": Regex}
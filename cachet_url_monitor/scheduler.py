@@ -6,9 +6,7 @@ import time
 import os
 from typing import List
 
-from yaml import load, SafeLoader
-
-from cachet_url_monitor.client import CachetClient
+from cachet_url_monitor.client import CachetClient, load_config
 from cachet_url_monitor.configuration import Configuration
 from cachet_url_monitor.webhook import Webhook
 from cachet_url_monitor.plugins.token_provider import get_token
@@ -92,7 +90,7 @@ class Scheduler(object):
         self.logger.info("Starting monitor agent...")
         while not self.stop:
             self.agent.execute()
-            time.sleep(self.configuration.endpoint["frequency"])
+            time.sleep(self.configuration.frequency)
 
 
 class NewThread(threading.Thread):
@@ -109,7 +107,7 @@ class NewThread(threading.Thread):
 def build_agent(configuration: Configuration, logger: logging.Logger):
     actions: List[Decorator] = []
     for action in configuration.get_action():
-        logger.info(f"Registering action {action}")
+        logger.info("Registering action %s", action)
         actions.append(ACTION_NAMES_DECORATOR_MAP[action]())
     return Agent(configuration, decorators=actions)
 
@@ -142,7 +140,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        config_data = load(open(sys.argv[1], "r"), SafeLoader)
+        config_data = load_config(sys.argv[1])
     except FileNotFoundError:
         fatal_error(f"File not found: {sys.argv[1]}")
         sys.exit(1)
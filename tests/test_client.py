@@ -1,10 +1,12 @@
 #!/usr/bin/env python
+import os
+import tempfile
 import unittest
 from typing import Dict, List
 
 import requests_mock
 
-from cachet_url_monitor.client import CachetClient
+from cachet_url_monitor.client import CachetClient, load_config, save_config
 from cachet_url_monitor.exceptions import MetricNonexistentError
 from cachet_url_monitor.status import ComponentStatus
 
@@ -28,6 +30,25 @@ class ClientTest(unittest.TestCase):
 
         self.assertEqual(components, [{"id": 1}], "Getting components list is incorrect.")
 
+    @requests_mock.mock()
+    def test_get_components_paginated(self, m):
+        m.get(
+            f"{CACHET_URL}/components?enabled=1&per_page=100",
+            complete_qs=True,
+            json={
+                "data": [{"id": 1}],
+                "meta": {"pagination": {"links": {"next_page": f"{CACHET_URL}/components?p=2"}}},
+            },
+        )
+        m.get(
+            f"{CACHET_URL}/components?p=2",
+            complete_qs=True,
+            json={"data": [{"id": 2}], "meta": {"pagination": {"links": {"next_page": None}}}},
+        )
+        components = self.client.get_components(enabled=1)
+
+        self.assertEqual(components, [{"id": 1}, {"id": 2}], "Getting paginated components list is incorrect.")
+
     @requests_mock.mock()
     def test_get_metrics(self, m):
         m.get(f"{CACHET_URL}/metrics", json=JSON)
@@ -90,6 +111,15 @@ class ClientTest(unittest.TestCase):
 
         self.assertEqual(default_metric_value, 0.456, "Getting default metric value is incorrect.")
 
+    @requests_mock.mock()
+    def test_get_default_metric_value_cached(self, m):
+        m.get(f"{CACHET_URL}/metrics/123", json={"data": {"default_value": 0.456}}, headers={"X-Cachet-Token": TOKEN})
+        self.client.get_default_metric_value(123)
+        default_metric_value = self.client.get_default_metric_value(123)
+
+        self.assertEqual(default_metric_value, 0.456, "Getting default metric value is incorrect.")
+        self.assertEqual(m.call_count, 1, "The default metric value should be fetched only once.")
+
     @requests_mock.mock()
     def test_get_default_metric_value_invalid_id(self, m):
         m.get(f"{CACHET_URL}/metrics/123", headers={"X-Cachet-Token": TOKEN}, status_code=400)
@@ -115,3 +145,51 @@ class ClientTest(unittest.TestCase):
         response = self.client.push_status(123, ComponentStatus.PARTIAL_OUTAGE)
 
         self.assertTrue(response.ok, "Pushing status value is failed.")
+
+    @requests_mock.mock()
+    def test_push_incident_new(self, m):
+        m.post(f"{CACHET_URL}/incidents?name=foo&status=1&component_id=123&component_status=3", json={"data": {}})
+        response = self.client.push_incident(ComponentStatus.PARTIAL_OUTAGE, True, 123, "foo", message="bar")
+
+        self.assertTrue(response.ok, "Pushing new incident is failed.")
+
+    @requests_mock.mock()
+    def test_push_incident_fixed(self, m):
+        m.post(f"{CACHET_URL}/incidents/10/updates?status=4&message=foo", json={"data": {}})
+        response = self.client.push_incident(ComponentStatus.OPERATIONAL, True, 123, "foo", previous_incident_id=10)
+
+        self.assertTrue(response.ok, "Pushing incident update is failed.")
+
+    def test_push_incident_no_change(self):
+        response = self.client.push_incident(ComponentStatus.OPERATIONAL, True, 123, "foo")
+
+        self.assertIsNone(response, "No incident should be pushed when there is no change.")
+
+
+class ConfigFileTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {"cachet": {"api_url": CACHET_URL, "token": TOKEN}, "endpoints": [{"name": "apache"}]}
+
+    def test_save_and_load_yaml(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "config.yml")
+            save_config(self.config, filename)
+
+            self.assertEqual(load_config(filename), self.config, "YAML configuration was not persisted correctly.")
+
+    def test_load_utf8_yaml(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "config.yml")
+            with open(filename, "wb") as file:
+                file.write("endpoints:\n  - name: caf\u00e9\n".encode("utf-8"))
+
+            self.assertEqual(load_config(filename), {"endpoints": [{"name": "caf\u00e9"}]})
+
+    def test_save_and_load_json(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "config.json")
+            save_config(self.config, filename)
+
+            with open(filename, "r") as file:
+                self.assertTrue(file.read().startswith("{"), "Configuration was not written as JSON.")
+            self.assertEqual(load_config(filename), self.config, "JSON configuration was not persisted correctly.")
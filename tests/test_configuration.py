@@ -11,6 +11,64 @@ from cachet_url_monitor.webhook import Webhook
 
 from cachet_url_monitor.configuration import Configuration
 import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class QueuedResponseHandler(BaseHTTPRequestHandler):
+    """Answers with the server's queued responses, in order, repeating the last one once the queue is exhausted."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super(QueuedResponseHandler, self).setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        responses = self.server.responses
+        status_code, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_queued_responses():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), QueuedResponseHandler)
+    server.daemon_threads = True
+    server.responses = [(200, {}, b"<body>")]
+    server.requests = 0
+    server.connections = 0
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def http_server():
+    yield from serve_queued_responses()
+
+
+@pytest.fixture()
+def redirect_target_server():
+    yield from serve_queued_responses()
+
+
+@pytest.fixture()
+def local_configuration(multiple_urls_config_file, mock_client, http_server):
+    multiple_urls_config_file["endpoints"][0]["url"] = "http://127.0.0.1:%d/" % (http_server.server_address[1],)
+    yield Configuration(multiple_urls_config_file, 0, mock_client)
 
 
 @pytest.fixture()
@@ -134,6 +192,15 @@ def test_init(configuration, mock_client):
     mock_client.get_default_metric_value.assert_not_called()
 
 
+def test_repr(configuration, config_file):
+    representation = repr(configuration)
+
+    assert "name: foo" in representation
+    assert "api_url: https://demo.cachethq.io/api/v1" in representation
+    assert "my_token" not in representation
+    assert config_file["cachet"]["token"] == "my_token", "The configuration data must not be modified"
+
+
 def test_init_with_header(header_configuration):
     assert len(header_configuration.data) == 2, "Number of root elements in config.yml is incorrect"
     assert len(header_configuration.expectations) == 3, "Number of expectations read from file is incorrect"
@@ -146,6 +213,48 @@ def test_init_missing_latency_unit(missing_latency_unit_config_file, mock_client
     assert configuration.latency_unit == "s"
 
 
+def test_init_null_allowed_fails(config_file, mock_client):
+    config_file["endpoints"][0]["allowed_fails"] = None
+    configuration = Configuration(config_file, 0, mock_client)
+
+    assert configuration.allowed_fails == 0
+
+
+def test_init_empty_allowed_fails(config_file, mock_client):
+    config_file["endpoints"][0]["allowed_fails"] = ""
+
+    with pytest.raises(cachet_url_monitor.configuration.ConfigurationValidationError):
+        Configuration(config_file, 0, mock_client)
+
+
+def test_init_negative_allowed_fails(config_file, mock_client):
+    config_file["endpoints"][0]["allowed_fails"] = -1
+
+    with pytest.raises(cachet_url_monitor.configuration.ConfigurationValidationError):
+        Configuration(config_file, 0, mock_client)
+
+
+def test_init_invalid_latency_unit(config_file, mock_client):
+    config_file["endpoints"][0]["latency_unit"] = "fortnights"
+
+    with pytest.raises(cachet_url_monitor.configuration.ConfigurationValidationError):
+        Configuration(config_file, 0, mock_client)
+
+
+def test_init_null_latency_unit(config_file, mock_client):
+    config_file["endpoints"][0]["latency_unit"] = None
+    configuration = Configuration(config_file, 0, mock_client)
+
+    assert configuration.latency_unit == "s"
+
+
+def test_init_empty_latency_unit(config_file, mock_client):
+    config_file["endpoints"][0]["latency_unit"] = ""
+
+    with pytest.raises(cachet_url_monitor.configuration.ConfigurationValidationError):
+        Configuration(config_file, 0, mock_client)
+
+
 def test_init_unknown_status(config_file, mock_client):
     mock_client.get_component_status.return_value = cachet_url_monitor.status.ComponentStatus.UNKNOWN
     configuration = Configuration(config_file, 0, mock_client)
@@ -168,6 +277,26 @@ def test_init_with_metric_id(metric_config_file, mock_client):
     mock_client.get_default_metric_value.assert_called_once_with(3)
 
 
+def test_push_metrics(metric_config_file, mock_client):
+    push_metrics_response = mock.Mock()
+    push_metrics_response.ok = True
+    mock_client.push_metrics.return_value = push_metrics_response
+    configuration = Configuration(metric_config_file, 0, mock_client)
+
+    configuration.push_metrics()
+    mock_client.push_metrics.assert_not_called()
+
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", text="<body>")
+        configuration.evaluate()
+
+    assert configuration.elapsed_seconds > 0
+    configuration.push_metrics()
+    mock_client.push_metrics.assert_called_once_with(
+        3, "ms", configuration.elapsed_seconds, configuration.current_timestamp
+    )
+
+
 def test_evaluate(configuration):
     with requests_mock.mock() as m:
         m.get("http://localhost:8080/swagger", text="<body>")
@@ -181,6 +310,200 @@ def test_evaluate(configuration):
         )
 
 
+def test_evaluate_reads_body_for_regex(configuration):
+    assert configuration.needs_body
+
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", text="<body>")
+        configuration.evaluate()
+
+        assert configuration.request.text == "<body>"
+
+
+def test_evaluate_reads_body_without_guessing_charset(configuration):
+    with requests_mock.mock() as m, mock.patch.object(
+        requests.Response, "apparent_encoding", new_callable=mock.PropertyMock
+    ) as mock_apparent_encoding:
+        m.get("http://localhost:8080/swagger", content="<body>".encode("utf-8"))
+        configuration.evaluate()
+
+        assert configuration.request.encoding is None
+        assert (
+            configuration.status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+        ), "Component status set incorrectly"
+        mock_apparent_encoding.assert_not_called()
+
+
+def test_evaluate_reads_body_with_byte_order_mark(config_file, mock_client):
+    config_file["endpoints"][0]["expectation"][2]["regex"] = '\\{"status": "ok"\\}'
+    configuration = Configuration(config_file, 0, mock_client)
+
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", content=b'\xef\xbb\xbf{"status": "ok"}')
+        configuration.evaluate()
+
+        assert configuration.request.encoding is None
+        assert (
+            configuration.status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+        ), "Component status set incorrectly"
+
+
+def test_evaluate_reads_body_prefix_with_byte_order_mark(config_file, mock_client):
+    config_file["endpoints"][0]["expectation"][2]["regex"] = '\\{"status": "ok"\\}'
+    config_file["endpoints"][0]["max_body_size"] = 100
+    configuration = Configuration(config_file, 0, mock_client)
+
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", content=b'\xef\xbb\xbf{"status": "ok"}')
+        configuration.evaluate()
+
+        assert (
+            configuration.status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+        ), "Component status set incorrectly"
+
+
+def test_evaluate_reads_body_prefix(config_file, mock_client):
+    config_file["endpoints"][0]["max_body_size"] = 8
+    configuration = Configuration(config_file, 0, mock_client)
+
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", text="<body>" + "x" * 100000)
+        with mock.patch.object(type(configuration.expectations[-1]), "get_status") as mock_get_status:
+            mock_get_status.return_value = cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+            configuration.evaluate()
+
+        mock_get_status.assert_called_once_with(configuration.request, "<body>xx", configuration.elapsed_seconds)
+        assert configuration.status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+
+
+def test_invalid_max_body_size(config_file, mock_client):
+    config_file["endpoints"][0]["max_body_size"] = 0
+
+    with pytest.raises(cachet_url_monitor.configuration.ConfigurationValidationError):
+        Configuration(config_file, 0, mock_client)
+
+
+def test_evaluate_skips_body_without_regex(multiple_urls_configuration):
+    configuration = multiple_urls_configuration[0]
+    assert not configuration.needs_body
+
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", text="<body>" * 1000)
+        configuration.evaluate()
+
+        assert (
+            configuration.status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+        ), "Component status set incorrectly"
+        assert configuration.request.raw.closed
+
+
+def test_evaluate_keeps_connection_alive_without_regex(local_configuration, http_server):
+    assert not local_configuration.needs_body
+
+    for _ in range(4):
+        local_configuration.evaluate()
+
+    assert http_server.requests == 4
+    assert http_server.connections == 1
+
+
+def test_evaluate_keeps_connections_alive_across_redirect(local_configuration, http_server, redirect_target_server):
+    target_url = "http://127.0.0.1:%d/" % (redirect_target_server.server_address[1],)
+    http_server.responses = [(301, {"Location": target_url}, b"")]
+
+    for _ in range(3):
+        local_configuration.evaluate()
+
+    assert http_server.requests == 3
+    assert redirect_target_server.requests == 3
+    assert http_server.connections == 1
+    assert redirect_target_server.connections == 1
+
+
+def test_evaluate_drops_connection_for_large_body(local_configuration, http_server):
+    http_server.responses = [(200, {}, b"<body>" * 1000)]
+
+    for _ in range(2):
+        local_configuration.evaluate()
+
+    assert http_server.requests == 2
+    assert http_server.connections == 2
+
+
+def test_evaluate_with_head(multiple_urls_config_file, mock_client):
+    multiple_urls_config_file["endpoints"][0]["use_head"] = True
+    configuration = Configuration(multiple_urls_config_file, 0, mock_client)
+    assert configuration.request_method == "HEAD"
+
+    with requests_mock.mock() as m:
+        m.head("http://localhost:8080/swagger")
+        configuration.evaluate()
+
+        assert m.last_request.method == "HEAD"
+        assert (
+            configuration.status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+        ), "Component status set incorrectly"
+
+
+def test_head_ignored_when_body_is_needed(config_file, mock_client):
+    config_file["endpoints"][0]["use_head"] = True
+    configuration = Configuration(config_file, 0, mock_client)
+
+    assert configuration.request_method == "GET"
+
+
+def test_evaluate_retries_transient_failures(local_configuration, http_server):
+    http_server.responses = [(503, {}, b"unavailable"), (200, {}, b"<body>")]
+    local_configuration.evaluate()
+
+    assert http_server.requests == 2
+    assert (
+        local_configuration.status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+    ), "Component status set incorrectly"
+
+
+def test_evaluate_with_slow_response(mock_logger, local_configuration, http_server):
+    http_server.delay = 0.6
+    local_configuration.endpoint_timeout = 0.2
+    local_configuration.evaluate()
+
+    assert http_server.requests == 1
+    assert (
+        local_configuration.status == cachet_url_monitor.status.ComponentStatus.PERFORMANCE_ISSUES
+    ), "Component status set incorrectly"
+    mock_logger.warning.assert_called_with("Request timed out")
+
+
+def test_evaluate_latency_includes_redirects(multiple_urls_config_file, mock_client, http_server):
+    endpoint = multiple_urls_config_file["endpoints"][0]
+    endpoint["url"] = "http://127.0.0.1:%d/" % (http_server.server_address[1],)
+    endpoint["expectation"].append({"type": "LATENCY", "threshold": 0.3})
+    configuration = Configuration(multiple_urls_config_file, 0, mock_client)
+    http_server.responses = [(301, {"Location": "/ok"}, b""), (200, {}, b"<body>")]
+    http_server.delay = 0.2
+
+    configuration.evaluate()
+
+    assert configuration.request.elapsed.total_seconds() < 0.3
+    assert configuration.elapsed_seconds > 0.3
+    assert (
+        configuration.status == cachet_url_monitor.status.ComponentStatus.PERFORMANCE_ISSUES
+    ), "Component status set incorrectly"
+    assert configuration.message == "Latency above threshold: %.4f seconds" % (configuration.elapsed_seconds,)
+
+
+def test_evaluate_ignores_retry_after(local_configuration, http_server):
+    http_server.responses = [(503, {"Retry-After": "3"}, b"unavailable")]
+    start = time.monotonic()
+    local_configuration.evaluate()
+
+    assert time.monotonic() - start < 2
+    assert http_server.requests == 3
+    assert (
+        local_configuration.status == cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+    ), "Component status set incorrectly"
+
+
 def test_evaluate_insecure(insecure_configuration):
     with requests_mock.mock() as m:
         m.get("http://localhost:8080/swagger", text="<body>")
@@ -194,6 +517,17 @@ def test_evaluate_insecure(insecure_configuration):
         )
 
 
+def test_evaluate_insecure_without_header(insecure_config_file, mock_client):
+    del insecure_config_file["endpoints"][0]["header"]
+    configuration = Configuration(insecure_config_file, 0, mock_client)
+
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", text="<body>")
+        configuration.evaluate()
+
+        assert m.last_request.verify == False
+
+
 def test_evaluate_without_header(configuration):
     with requests_mock.mock() as m:
         m.get("http://localhost:8080/swagger", text="<body>")
@@ -224,6 +558,39 @@ def test_evaluate_with_failure(configuration):
         ), "Component status set incorrectly or custom incident status is incorrectly parsed"
 
 
+def test_evaluate_with_failure_skips_remaining_expectations(configuration):
+    regex = configuration.expectations[-1]
+    assert regex.needs_body
+
+    with requests_mock.mock() as m, mock.patch.object(type(regex), "get_status") as mock_get_status:
+        m.get("http://localhost:8080/swagger", text="<body>", status_code=400)
+        configuration.evaluate()
+
+        assert configuration.status == cachet_url_monitor.status.ComponentStatus.MAJOR_OUTAGE
+        mock_get_status.assert_not_called()
+
+
+def test_evaluate_builds_only_the_worst_message(configuration):
+    latency = type(configuration.expectations[1])
+    with requests_mock.mock() as m, mock.patch.object(latency, "get_status") as mock_get_status, mock.patch.object(
+        latency, "get_message"
+    ) as mock_get_message:
+        mock_get_status.return_value = cachet_url_monitor.status.ComponentStatus.PERFORMANCE_ISSUES
+        m.get("http://localhost:8080/swagger", text="nothing to see here")
+        configuration.evaluate()
+
+        assert configuration.status == cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+        assert configuration.message == "Regex did not match anything in the body"
+        mock_get_message.assert_not_called()
+
+
+def test_expectations_reading_body_run_last(config_file, mock_client):
+    config_file["endpoints"][0]["expectation"].reverse()
+    configuration = Configuration(config_file, 0, mock_client)
+
+    assert [expectation.needs_body for expectation in configuration.expectations] == [False, False, True]
+
+
 def test_evaluate_with_timeout(configuration, mock_logger):
     with requests_mock.mock() as m:
         m.get("http://localhost:8080/swagger", exc=requests.Timeout)
@@ -246,6 +613,28 @@ def test_evaluate_with_connection_error(configuration, mock_logger):
         mock_logger.warning.assert_called_with("The URL is unreachable: GET http://localhost:8080/swagger")
 
 
+def test_evaluate_with_connect_timeout(configuration, mock_logger):
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", exc=requests.ConnectTimeout)
+        configuration.evaluate()
+
+        assert (
+            configuration.status == cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+        ), "Component status set incorrectly"
+        mock_logger.warning.assert_called_with("The URL is unreachable: GET http://localhost:8080/swagger")
+
+
+def test_evaluate_with_too_many_redirects(configuration, mock_logger):
+    with requests_mock.mock() as m:
+        m.get("http://localhost:8080/swagger", exc=requests.TooManyRedirects)
+        configuration.evaluate()
+
+        assert (
+            configuration.status == cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+        ), "Component status set incorrectly"
+        mock_logger.exception.assert_called_with("Unexpected HTTP response")
+
+
 def test_evaluate_with_http_error(configuration, mock_logger):
     with requests_mock.mock() as m:
         m.get("http://localhost:8080/swagger", exc=requests.HTTPError)
@@ -274,7 +663,7 @@ def test_webhooks(webhooks_configuration, mock_logger, mock_client):
         mock_logger.exception.assert_called_with("Unexpected HTTP response")
         webhooks_configuration.push_incident()
         mock_logger.info.assert_called_with(
-            "Webhook https://push.example.com/message?token=<apptoken> triggered with foo unavailable"
+            "Webhook %s triggered with %s", "https://push.example.com/message?token=<apptoken>", "foo unavailable"
         )
 
 
@@ -289,6 +678,8 @@ def test_push_status(configuration, mock_client):
     configuration.push_status()
 
     mock_client.push_status.assert_called_once_with(1, cachet_url_monitor.status.ComponentStatus.OPERATIONAL)
+    # Only the initial status is fetched, when the configuration is created.
+    mock_client.get_component_status.assert_called_once_with(1)
 
 
 def test_push_status_with_new_failure(configuration, mock_client):
@@ -303,6 +694,34 @@ def test_push_status_with_new_failure(configuration, mock_client):
     mock_client.push_status.assert_called_once_with(1, cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE)
 
 
+def test_push_status_retried_after_failure(configuration, mock_client):
+    push_status_response = mock.Mock()
+    mock_client.push_status.return_value = push_status_response
+    push_status_response.ok = False
+    configuration.status = cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+
+    configuration.push_status()
+
+    assert configuration.previous_status == cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+    push_status_response.ok = True
+    configuration.push_status()
+
+    assert mock_client.push_status.call_count == 2
+    assert configuration.previous_status == cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+
+
+def test_push_status_failure_without_cachet(configuration, mock_client):
+    push_status_response = mock.Mock()
+    mock_client.push_status.return_value = push_status_response
+    push_status_response.ok = False
+    mock_client.get_component_status.side_effect = requests.ConnectionError
+    configuration.status = cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+
+    configuration.push_status()
+
+    assert configuration.previous_status == cachet_url_monitor.status.ComponentStatus.UNKNOWN
+
+
 def test_push_status_same_status(configuration, mock_client):
     mock_client.get_component_status.return_value = cachet_url_monitor.status.ComponentStatus.OPERATIONAL
     configuration.status = cachet_url_monitor.status.ComponentStatus.OPERATIONAL
@@ -329,3 +748,51 @@ def test_init_multiple_urls(multiple_urls_configuration):
 def test_init_invalid_configuration(invalid_config_file, mock_client):
     with pytest.raises(cachet_url_monitor.configuration.ConfigurationValidationError):
         Configuration(invalid_config_file, 0, mock_client)
+
+
+def test_push_incident_creates_and_resolves_incident(configuration, mock_client):
+    push_incident_response = mock.Mock()
+    push_incident_response.ok = True
+    push_incident_response.json.return_value = {"data": {"id": 10}}
+    mock_client.push_incident.return_value = push_incident_response
+    assert configuration.incident_id is None
+
+    configuration.status = cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+    configuration.push_incident()
+    assert configuration.incident_id == 10
+
+    configuration.status = cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+    configuration.push_incident()
+    assert configuration.incident_id is None
+    mock_client.push_incident.assert_called_with(
+        cachet_url_monitor.status.ComponentStatus.OPERATIONAL, 1, 1, "foo is operational", previous_incident_id=10
+    )
+
+
+def test_if_trigger_update_allowed_fails(configuration, mock_logger):
+    configuration.allowed_fails = 1
+    configuration.status = cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+
+    configuration.if_trigger_update()
+    assert not configuration.trigger_update
+    assert configuration.current_fails == 1
+    mock_logger.warning.assert_called_with("Failure #%d with threshold set to %d", 1, 1)
+
+    configuration.if_trigger_update()
+    assert configuration.trigger_update
+    assert configuration.current_fails == 0
+
+    configuration.status = cachet_url_monitor.status.ComponentStatus.OPERATIONAL
+    configuration.if_trigger_update()
+    assert configuration.trigger_update
+    assert configuration.current_fails == 0
+
+
+def test_if_trigger_update_keeps_incident(configuration):
+    configuration.incident_id = 10
+    configuration.status = cachet_url_monitor.status.ComponentStatus.PARTIAL_OUTAGE
+
+    configuration.if_trigger_update()
+
+    assert configuration.trigger_update
+    assert configuration.incident_id == 10
@@ -5,10 +5,22 @@ import unittest
 import mock
 import pytest
 
-from cachet_url_monitor.expectation import HttpStatus, Regex, Latency
+from cachet_url_monitor.exceptions import ConfigurationValidationError
+from cachet_url_monitor.expectation import Expectation, HttpStatus, Regex, Latency
 from cachet_url_monitor.status import ComponentStatus
 
 
+class ExpectationTest(unittest.TestCase):
+    def test_create(self):
+        assert isinstance(Expectation.create({"type": "HTTP_STATUS", "status_range": "200-300"}), HttpStatus)
+        assert isinstance(Expectation.create({"type": "LATENCY", "threshold": 1}), Latency)
+        assert isinstance(Expectation.create({"type": "REGEX", "regex": ".*"}), Regex)
+
+    def test_create_invalid_type(self):
+        with pytest.raises(ConfigurationValidationError):
+            Expectation.create({"type": "FOO"})
+
+
 class LatencyTest(unittest.TestCase):
     def setUp(self):
         self.expectation = Latency({"type": "LATENCY", "threshold": 1})
@@ -49,6 +61,13 @@ class LatencyTest(unittest.TestCase):
 
         assert self.expectation.get_message(request) == ("Latency above " "threshold: 0.1000 seconds")
 
+    def test_get_status_uses_elapsed_seconds(self):
+        request = mock.Mock()
+        request.elapsed.total_seconds.return_value = 0.1
+
+        assert self.expectation.get_status(request, None, 2.0) == ComponentStatus.PERFORMANCE_ISSUES
+        assert self.expectation.get_message(request, 2.0) == "Latency above threshold: 2.0000 seconds"
+
 
 class HttpStatusTest(unittest.TestCase):
     def setUp(self):
@@ -56,6 +75,7 @@ class HttpStatusTest(unittest.TestCase):
 
     def test_init(self):
         assert self.expectation.status_range == (200, 300)
+        assert self.expectation.status_codes == range(200, 300)
 
     def test_init_with_one_status(self):
         """With only one value, we still expect a valid tuple"""
@@ -106,6 +126,31 @@ class RegexTest(unittest.TestCase):
     def test_init(self):
         assert self.expectation.regex == re.compile(".*(find stuff).*", re.UNICODE + re.DOTALL)
 
+    def test_init_shares_compiled_regex(self):
+        expectation = Regex({"type": "REGEX", "regex": ".*(find stuff).*"})
+
+        assert expectation.regex is self.expectation.regex
+
+    def test_init_literal(self):
+        assert self.expectation.literal == "find stuff"
+
+    def test_init_literal_not_plain_search(self):
+        assert Regex({"type": "REGEX", "regex": ".*find.*stuff"}).literal is None
+        assert Regex({"type": "REGEX", "regex": "find stuff.*"}).literal is None
+
+    def test_get_status_with_decoded_body(self):
+        request = mock.Mock()
+        request.text = "We will not find it here"
+
+        assert self.expectation.get_status(request, "We could find stuff") == ComponentStatus.OPERATIONAL
+
+    def test_get_status_anchored(self):
+        expectation = Regex({"type": "REGEX", "regex": "find stuff"})
+        request = mock.Mock()
+        request.text = "We could find stuff"
+
+        assert expectation.get_status(request) == ComponentStatus.PARTIAL_OUTAGE
+
     def test_get_status_healthy(self):
         request = mock.Mock()
         request.text = "We could find stuff\n in this body."